@@ -1,174 +1,336 @@
 import fitz  # PyMuPDF
 import camelot
+import numpy as np
 import json
+import os
 import collections
 import re
-import statistics
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+# Matches section numbering such as "1", "2.3" or "4.1.2." at the start of a line
+_NUM_RE = re.compile(r'^\s*\d+(?:\.\d+)*\.?\s*')
 
 class UltimateExtractor:
-    def __init__(self, pdf_path):
+    def __init__(self, pdf_path, overlap_tables=None):
         self.pdf_path = pdf_path
+        # Run Camelot in its own process alongside MuPDF; only worth it with a spare core
+        if overlap_tables is None:
+            overlap_tables = (os.cpu_count() or 1) > 1
+        self.overlap_tables = overlap_tables
         self.doc = fitz.open(pdf_path)
+        self.page_heights = []
+        self.page_widths = []
         self.blocks = []
         self.title = ""
         self.outline = []
 
     def run(self):
         """Executes the full extraction pipeline."""
-        table_areas = self._detect_tables()
-        self._create_blocks(table_areas)
-        self._detect_and_filter_boilerplate()
-        self._find_title()
-        self._find_headings()
+        print("Stage 1: Detecting table areas with Camelot...")
+        # Page geometry is cached so the document can be closed once text extraction is done
+        candidate_pages, self.page_heights, self.page_widths = self._find_table_candidate_pages()
+        print(f"  {len(candidate_pages)} of {len(self.page_heights)} pages have ruled lines.")
+        char_level_pages = {page_no - 1 for page_no in candidate_pages}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            camelot_input = self._prepare_camelot_input(candidate_pages, tmp_dir) if candidate_pages else None
+            if camelot_input is not None:
+                camelot_path, page_map = camelot_input
+                if self.overlap_tables:
+                    # Camelot renders pages in a worker process while MuPDF extracts the text here
+                    with ProcessPoolExecutor(max_workers=1) as ex:
+                        tables_future = ex.submit(_camelot_detect, camelot_path)
+                        page_blocks, table_page_spans = self._collect_spans(char_level_pages)
+                        try:
+                            raw_tables = tables_future.result()
+                        except Exception:
+                            # A dead worker (OOM kill, broken pool) just means no tables to exclude
+                            raw_tables = []
+                else:
+                    raw_tables = _camelot_detect(camelot_path)
+                    page_blocks, table_page_spans = self._collect_spans(char_level_pages)
+                table_areas = self._detect_tables(raw_tables, page_map)
+            else:
+                page_blocks, table_page_spans = self._collect_spans(char_level_pages)
+                table_areas = {}
         self.doc.close()
+
+        self._create_blocks(page_blocks, table_page_spans, table_areas)
+        self._detect_and_filter_boilerplate()
+
+        # One pass over the blocks feeds both the title and the heading stages
+        top_first_page_blocks = []
+        size_counter = collections.Counter()
+        if self.page_heights:
+            page_height = self.page_heights[0]
+            for block in self.blocks:
+                size_counter[block['size_i']] += 1
+                if block['page'] == 0 and block['bbox'][1] < page_height * 0.5:
+                    top_first_page_blocks.append(block)
+        self._classify(top_first_page_blocks, size_counter)
         return {"title": self.title, "outline": self.outline}
 
-    def _detect_tables(self):
-        """Uses Camelot to find all table areas in the PDF."""
-        print("Stage 1: Detecting table areas with Camelot...")
+    def _prepare_camelot_input(self, candidate_pages, tmp_dir):
+        """
+        Returns the PDF path to hand Camelot and the original page number of each of its pages,
+        or None if the candidate-page subset cannot be written.
+        """
+        if len(candidate_pages) == self.doc.page_count:
+            return self.pdf_path, candidate_pages
+
+        # Hand Camelot a copy of just the candidate pages, written from the already
+        # open document, so it does not re-read the whole file for every page it splits
+        camelot_path = os.path.join(tmp_dir, "candidates.pdf")
+        subset = fitz.open()
         try:
-            tables = camelot.read_pdf(self.pdf_path, pages='all', flavor='lattice', line_scale=40, suppress_stdout=True)
-        except Exception:
-            tables = []
-        
+            # Keep the graft map across calls (final=False) so shared fonts and images are copied once
+            for i, page_no in enumerate(candidate_pages):
+                subset.insert_pdf(self.doc, from_page=page_no - 1, to_page=page_no - 1, final=(i == len(candidate_pages) - 1))
+            subset.save(camelot_path)
+        except Exception as e:
+            # A document MuPDF can read but not re-serialize is handled like a Camelot failure
+            print(f"  Could not write the table candidate pages, no tables will be excluded: {e!r}")
+            return None
+        finally:
+            subset.close()
+        return camelot_path, candidate_pages
+
+    def _detect_tables(self, raw_tables, page_map):
+        """Maps Camelot's table bboxes back onto the pages of the document."""
         table_areas = collections.defaultdict(list)
-        for table in tables:
-            page = self.doc[table.page - 1]
-            page_height = page.rect.height
-            x1, y1, x2, y2 = table._bbox
-            table_rect = fitz.Rect(x1, page_height - y2, x2, page_height - y1)
-            table_areas[table.page - 1].append(table_rect)
-        print(f"  Found {len(tables)} table areas to exclude.")
-        return table_areas
-
-    def _create_blocks(self, table_areas):
+        for page, (x1, y1, x2, y2) in raw_tables:
+            page_idx = page_map[page - 1] - 1
+            page_height = self.page_heights[page_idx]
+            table_areas[page_idx].append((x1, page_height - y2, x2, page_height - y1))
+        print(f"  Found {len(raw_tables)} table areas to exclude.")
+        # One (T, 4) array of x0, y0, x1, y1 per page, ready for vectorized intersection tests
+        return {page_num: np.asarray(bboxes, dtype=np.float32) for page_num, bboxes in table_areas.items()}
+
+    def _find_table_candidate_pages(self):
+        """
+        Returns the 1-based numbers of pages with enough ruled lines to hold a lattice table,
+        along with every page's height and width, read while each page is loaded anyway.
+        """
+        candidate_pages = []
+        page_heights = []
+        page_widths = []
+        for page in self.doc:
+            page_rect = page.rect
+            page_heights.append(page_rect.height)
+            page_widths.append(page_rect.width)
+            h_lines = v_lines = 0
+            for path in page.get_drawings():
+                for item in path['items']:
+                    if item[0] == 'l':
+                        p1, p2 = item[1], item[2]
+                        if abs(p1.y - p2.y) < 1:
+                            h_lines += 1
+                        elif abs(p1.x - p2.x) < 1:
+                            v_lines += 1
+                    elif item[0] == 're':
+                        # Thin rectangles are often used to draw rules; others contribute four edges
+                        rect = item[1]
+                        if rect.height < 2:
+                            h_lines += 1
+                        elif rect.width < 2:
+                            v_lines += 1
+                        else:
+                            h_lines += 2
+                            v_lines += 2
+            if h_lines >= 3 and v_lines >= 3:
+                candidate_pages.append(page.number + 1)
+        return candidate_pages, page_heights, page_widths
+
+    def _collect_spans(self, char_level_pages):
         """
-        Creates logical text blocks, ignoring tables and text in the page margins.
+        Collects the text spans of every page, ignoring text in the page margins.
+        Spans crossing a margin edge, and every span on pages in char_level_pages, are split
+        into single characters so only the glyphs outside the content area or a table are lost.
+        Pages outside char_level_pages cannot hold a table, so their blocks are built right away
+        and only the char-level pages keep their spans until the table areas are known.
+        Returns the blocks of each page and a {page_num: (spans, bboxes)} map of deferred pages.
         """
         print("Stage 2: Creating logical text blocks and ignoring margins...")
+        page_blocks = []
+        table_page_spans = {}
         for page_num, page in enumerate(self.doc):
-            page_table_bboxes = table_areas.get(page_num, [])
-            
             # FINAL FIX: Define a content area to ignore vertical text in margins
-            page_width = page.rect.width
+            page_width = self.page_widths[page_num]
             margin_x0 = page_width * 0.10  # 10% margin from the left
             margin_x1 = page_width * 0.90  # 10% margin from the right
 
-            chars = []
-            blocks_raw = page.get_text("rawdict")["blocks"]
-            for b in blocks_raw:
-                if 'lines' in b:
-                    for l in b['lines']:
-                        for s in l['spans']:
-                            for c in s['chars']:
-                                char_rect = fitz.Rect(c['bbox'])
-                                is_in_table = any(char_rect.intersects(bbox) for bbox in page_table_bboxes)
-                                
-                                # Check if character is within the central content area
-                                is_in_margin = c['bbox'][0] < margin_x0 or c['bbox'][2] > margin_x1
-                                
-                                if not is_in_table and not is_in_margin and c['c'].strip():
-                                    c['font'] = s['font']
-                                    c['size'] = s['size']
-                                    chars.append(c)
-            
-            if not chars: continue
-
-            lines = collections.defaultdict(list)
-            for char in sorted(chars, key=lambda c: (c['bbox'][1], c['bbox'][0])):
-                y0 = round(char['bbox'][1])
-                found_line = False
-                for y_key in lines:
-                    if abs(y_key - y0) < 2:
-                        lines[y_key].append(char)
-                        found_line = True
-                        break
-                if not found_line:
-                    lines[y0].append(char)
-
-            for y0 in sorted(lines.keys()):
-                line_chars = sorted(lines[y0], key=lambda c: c['bbox'][0])
-                if not line_chars: continue
-
-                full_text = ""
-                for i, char_info in enumerate(line_chars):
-                    full_text += char_info['c']
-                    if i < len(line_chars) - 1:
-                        next_char_info = line_chars[i+1]
-                        gap = next_char_info['bbox'][0] - char_info['bbox'][2]
-                        if gap > 1.0:
-                            full_text += " "
-                
-                first_char = line_chars[0]
-                last_char = line_chars[-1]
-                self.blocks.append({
-                    'text': full_text.strip(), 'size': first_char['size'], 'font': first_char['font'],
-                    'page': page_num, 'bbox': fitz.Rect(first_char['bbox'][0], first_char['bbox'][1], last_char['bbox'][2], last_char['bbox'][3])
-                })
+            # Only (text, font, size) is kept per span; its bbox goes to a parallel list
+            spans = []
+            bboxes = []
+            spans_append = spans.append
+            bboxes_append = bboxes.append
+            # Pages that may hold a table are split into characters throughout so table edges
+            # cut cleanly; elsewhere only spans crossing a margin edge are. Both extractions read
+            # one shared text page, so a span's characters are found by its dict indices.
+            char_level = page_num in char_level_pages
+            # Keep the baseline's rawdict flags (ligatures, whitespace, CID fallback) for both modes
+            tp = page.get_textpage(flags=fitz.TEXTFLAGS_RAWDICT)
+            blocks_raw = page.get_text("rawdict" if char_level else "dict", textpage=tp)["blocks"]
+            raw_chars_blocks = blocks_raw if char_level else None
+            for b_idx, b in enumerate(blocks_raw):
+                if 'lines' not in b: continue
+                for l_idx, l in enumerate(b['lines']):
+                    for s_idx, s in enumerate(l['spans']):
+                        s_x0, _, s_x1, _ = s['bbox']
+                        # Spans lying wholly in a margin (stamps, line numbers) are dropped outright
+                        if s_x1 <= margin_x0 or s_x0 >= margin_x1:
+                            continue
+                        if char_level or s_x0 < margin_x0 or s_x1 > margin_x1:
+                            if raw_chars_blocks is None:
+                                raw_chars_blocks = page.get_text("rawdict", textpage=tp)["blocks"]
+                            font, size = s['font'], s['size']
+                            for c in raw_chars_blocks[b_idx]['lines'][l_idx]['spans'][s_idx]['chars']:
+                                if c['c'].strip():
+                                    spans_append((c['c'], font, size))
+                                    bboxes_append(c['bbox'])
+                        elif s['text'].strip():
+                            spans_append((s['text'], s['font'], s['size']))
+                            bboxes_append(s['bbox'])
+            del blocks_raw, raw_chars_blocks, tp
+
+            if spans:
+                # Filter all spans of the page in one vectorized pass over their bboxes
+                bb = np.asarray(bboxes, dtype=np.float32)
+                in_margin = (bb[:, 0] < margin_x0) | (bb[:, 2] > margin_x1)
+                keep = np.where(~in_margin)[0]
+                spans, bb = [spans[i] for i in keep], bb[keep]
+            else:
+                bb = np.empty((0, 4), dtype=np.float32)
+
+            if char_level:
+                table_page_spans[page_num] = (spans, bb)
+                page_blocks.append(None)
+            else:
+                page_blocks.append(self._line_blocks(page_num, spans, bb))
+        return page_blocks, table_page_spans
+
+    def _create_blocks(self, page_blocks, table_page_spans, table_areas):
+        """
+        Creates logical text blocks from the collected spans, ignoring tables.
+        """
+        for page_num, (spans, bb) in table_page_spans.items():
+            page_table_bboxes = table_areas.get(page_num)
+            if spans and page_table_bboxes is not None:
+                tb = page_table_bboxes
+                inter = ((bb[:, None, 0] < tb[None, :, 2]) & (bb[:, None, 2] > tb[None, :, 0]) &
+                         (bb[:, None, 1] < tb[None, :, 3]) & (bb[:, None, 3] > tb[None, :, 1]))
+                keep = np.where(~inter.any(axis=1))[0]
+                spans, bb = [spans[i] for i in keep], bb[keep]
+            page_blocks[page_num] = self._line_blocks(page_num, spans, bb)
+
+        blocks_extend = self.blocks.extend
+        for blocks in page_blocks:
+            blocks_extend(blocks)
+
+    def _line_blocks(self, page_num, spans, bb):
+        """Merges one page's (text, font, size) spans and their bbox rows into line blocks."""
+        blocks = []
+        if not spans: return blocks
+        blocks_append = blocks.append
+
+        # Sort once by baseline and sweep: a span starts a new line when it sits
+        # 2pt or more away from the first span of the current line. Lines are kept
+        # as boundaries into the sorted order rather than as separate lists.
+        order = np.lexsort((bb[:, 0], bb[:, 1]))
+        line_starts = []
+        cur_y = None
+        for k, y0 in enumerate(bb[order, 1].tolist()):
+            if cur_y is None or abs(y0 - cur_y) >= 2:
+                line_starts.append(k)
+                cur_y = y0
+        line_starts.append(len(order))
+
+        for start, end in zip(line_starts, line_starts[1:]):
+            line = order[start:end]
+            line = line[np.argsort(bb[line, 0], kind='stable')]
+            line_spans = [spans[i] for i in line]
+
+            # Insert a space wherever the gap to the previous span exceeds 1pt
+            insert_space = (bb[line[1:], 0] - bb[line[:-1], 2]) > 1.0
+
+            parts = [line_spans[0][0]]
+            append = parts.append
+            for (text, _, _), need_space in zip(line_spans[1:], insert_space):
+                if need_space:
+                    append(" ")
+                append(text)
+            # Collapse whitespace runs inside dict spans so every page yields char-level text
+            full_text = " ".join("".join(parts).split())
+
+            _, font, size = line_spans[0]
+            x0, y0 = bb[line[0], :2].tolist()
+            x1, y1 = bb[line[-1], 2:].tolist()
+            blocks_append({
+                'text': full_text, 'size': size, 'font': font,
+                'size_i': round(size), 'font_lc': font.lower(),
+                'page': page_num, 'bbox': (x0, y0, x1, y1)
+            })
+        return blocks
 
     def _detect_and_filter_boilerplate(self):
         """Finds and filters repeating headers/footers using a signature method."""
         print("Stage 3: Detecting and filtering boilerplate text...")
+        # Too few pages for repetition to tell headers/footers apart from real content
+        if len(self.page_heights) < 4: return
         signatures = collections.Counter()
         for block in self.blocks:
-            sig = f"{block['text']}|{round(block['size'])}|{round(block['bbox'].x0 / 10)}"
-            signatures[sig] += 1
+            block['_sig'] = f"{block['text']}|{block['size_i']}|{round(block['bbox'][0] / 10)}"
+            signatures[block['_sig']] += 1
         
-        repeat_threshold = max(2, int(self.doc.page_count * 0.25))
+        repeat_threshold = max(2, int(len(self.page_heights) * 0.25))
         boilerplate_sigs = {sig for sig, count in signatures.items() if count >= repeat_threshold}
         
-        self.blocks = [
-            block for block in self.blocks 
-            if f"{block['text']}|{round(block['size'])}|{round(block['bbox'].x0 / 10)}" not in boilerplate_sigs
-        ]
+        self.blocks = [block for block in self.blocks if block['_sig'] not in boilerplate_sigs]
 
-    def _find_title(self):
+    def _classify(self, top_first_page_blocks, size_counter):
+        """Assigns the title and the heading outline from the pre-collected block statistics."""
+        self._find_title(top_first_page_blocks)
+        self._find_headings(size_counter)
+
+    def _find_title(self, top_blocks):
         """Finds the title using proximity and style."""
         print("Stage 4: Finding the document title...")
-        first_page_blocks = [b for b in self.blocks if b['page'] == 0]
-        if not first_page_blocks: return
-
-        page_height = self.doc[0].rect.height
-        top_blocks = [b for b in first_page_blocks if b['bbox'].y0 < page_height * 0.5]
         if not top_blocks: return
 
+        page_height = self.page_heights[0]
+
         try:
             anchor_block = max(top_blocks, key=lambda x: x['size'])
             title_lines = [anchor_block]
             for block in top_blocks:
                 if block['text'] == anchor_block['text']: continue
                 is_large = block['size'] >= anchor_block['size'] * 0.75
-                is_close = abs(block['bbox'].y0 - anchor_block['bbox'].y0) < page_height * 0.1
+                is_close = abs(block['bbox'][1] - anchor_block['bbox'][1]) < page_height * 0.1
                 if is_large and is_close:
                     title_lines.append(block)
             
-            title_lines.sort(key=lambda x: x['bbox'].y0)
+            title_lines.sort(key=lambda x: x['bbox'][1])
             self.title = " ".join(line['text'] for line in title_lines)
         except ValueError:
             self.title = ""
 
-    def _find_headings(self):
+    def _find_headings(self, size_counter):
         """Finds headings using a unified, prioritized logic and then ranks them by style."""
         print("Stage 5: Finding and ranking headings...")
         potential_headings = []
         
-        if self.blocks:
-            font_sizes = [round(b['size']) for b in self.blocks]
-            try:
-                body_size = statistics.mode(font_sizes)
-            except statistics.StatisticsError:
-                body_size = collections.Counter(font_sizes).most_common(1)[0][0] if font_sizes else 10
-        else:
-            body_size = 10
+        body_size = size_counter.most_common(1)[0][0] if size_counter else 10
         print(f"  Detected body text font size: {body_size}")
+        body_size_threshold = body_size * 1.15
 
         for i, block in enumerate(self.blocks):
             text = block['text'].strip()
-            font_size = round(block['size'])
+            font_size = block['size_i']
             if not text or (self.title and text in self.title): continue
             if '....' in text: continue
 
-            is_numbered = re.match(r'^\s*(\d+(\.\d+)*\.?)\s*', text)
+            is_numbered = _NUM_RE.match(text)
             
             if is_numbered and font_size > body_size:
                 style_key = (font_size, block['font'])
@@ -176,13 +338,13 @@ class UltimateExtractor:
                 potential_headings.append(block)
                 continue
 
-            is_bold = 'bold' in block['font'].lower()
-            is_bigger = font_size > body_size * 1.15
+            is_bold = 'bold' in block['font_lc']
+            is_bigger = font_size > body_size_threshold
             
             has_space_below = False
             if i + 1 < len(self.blocks) and block['page'] == self.blocks[i+1]['page']:
-                vertical_gap = self.blocks[i+1]['bbox'].y0 - block['bbox'].y1
-                line_height = block['bbox'].y1 - block['bbox'].y0 if block['bbox'].y1 > block['bbox'].y0 else 1
+                vertical_gap = self.blocks[i+1]['bbox'][1] - block['bbox'][3]
+                line_height = block['bbox'][3] - block['bbox'][1] if block['bbox'][3] > block['bbox'][1] else 1
                 if vertical_gap > (line_height * 0.5):
                     has_space_below = True
             
@@ -205,8 +367,15 @@ class UltimateExtractor:
                 if int(level[1:]) <= 4:
                     outline_temp.append({"level": level, "text": h['text'], "page": h['page'], "bbox": h['bbox']})
         
-        final_outline_with_bbox = list({(item['text'], item['page']): item for item in outline_temp}.values())
-        final_outline_with_bbox.sort(key=lambda x: (x['page'], x['bbox'].y0))
+        # Keep the first heading seen for each (text, page) pair
+        seen = set()
+        final_outline_with_bbox = []
+        for item in outline_temp:
+            key = (item['text'], item['page'])
+            if key in seen: continue
+            seen.add(key)
+            final_outline_with_bbox.append(item)
+        final_outline_with_bbox.sort(key=lambda x: (x['page'], x['bbox'][1]))
         self.outline = [
             {"level": item["level"], "text": item["text"], "page": item["page"] + 1}
             for item in final_outline_with_bbox
@@ -215,18 +384,47 @@ class UltimateExtractor:
             h1s = [h for h in self.outline if h['level'] == 'H1']
             self.title = h1s[0]['text'] if h1s else ''
 
+def _camelot_detect(pdf_path):
+    """Runs Camelot's lattice detection and returns (page, bbox) pairs; runs in a worker process."""
+    try:
+        # Camelot >= 1.0 renders pages in-process with its default PDFium backend, no Ghostscript needed
+        tables = camelot.read_pdf(pdf_path, pages='all', flavor='lattice', line_scale=40, suppress_stdout=True)
+    except Exception as e:
+        # Carry on without table exclusion, but say so: a broken pypdfium2 would otherwise go unnoticed
+        print(f"  Camelot table detection failed, no tables will be excluded: {e!r}")
+        return []
+    return [(table.page, table._bbox) for table in tables]
+
 # --- Main execution block ---
-if __name__ == "__main__":
-    input_pdf = "file04.pdf"
-    output_json_path = f"{input_pdf.replace('.pdf', '')}.json"
+INPUT_DIR = Path("input")
+OUTPUT_DIR = Path("output")
 
-    print(f"Analyzing '{input_pdf}' with the definitive hybrid logic...")
-    extractor = UltimateExtractor(input_pdf)
+def _process_one(pdf_path, out_path, overlap_tables=None):
+    """Extracts the structure of a single PDF and saves it as JSON."""
+    print(f"Analyzing '{pdf_path}' with the definitive hybrid logic...")
+    extractor = UltimateExtractor(pdf_path, overlap_tables=overlap_tables)
     document_structure = extractor.run()
-    
-    with open(output_json_path, 'w', encoding='utf-8') as f:
+
+    with open(out_path, 'w', encoding='utf-8') as f:
         json.dump(document_structure, f, indent=4)
-        
-    print(f"\nSuccessfully saved to '{output_json_path}'")
-    print("\n--- Generated JSON Output ---")
-    print(json.dumps(document_structure, indent=4))
\ No newline at end of file
+
+    print(f"Successfully saved to '{out_path}'")
+
+if __name__ == "__main__":
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    pdf_files = sorted(INPUT_DIR.glob("*.pdf"))
+    if not pdf_files:
+        print(f"No PDF files found in '{INPUT_DIR}'.")
+    else:
+        # Each PDF is independent and CPU-bound, so spread them across processes. Each
+        # extractor only adds its own Camelot process when there is a core left for it.
+        cpu_count = os.cpu_count() or 1
+        max_workers = min(cpu_count, len(pdf_files))
+        overlap_tables = 2 * max_workers <= cpu_count
+        with ProcessPoolExecutor(max_workers=max_workers) as ex:
+            futs = {ex.submit(_process_one, str(p), str(OUTPUT_DIR / f"{p.stem}.json"), overlap_tables): p for p in pdf_files}
+            for f in as_completed(futs):
+                try:
+                    f.result()
+                except Exception as e:
+                    print(f"Failed to process '{futs[f]}': {e}")